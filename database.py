@@ -5,131 +5,414 @@ Handles SQLite database operations for storing violation data
 
 import sqlite3
 import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
 DATABASE_PATH = 'traffic_violations.db'
+SCHEMA_VERSION = 4  # Stored in PRAGMA user_version
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
 
-def get_db_connection():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Applied once per connection when it is opened; only journal_mode
+# persists in the database file, the rest are per-connection settings
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA foreign_keys=ON',
+    'PRAGMA busy_timeout=5000',
+)
 
-def init_db():
-    """Initialize database with required tables"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Create violations table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS violations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT NOT NULL,
-            violation_type TEXT NOT NULL,
-            confidence REAL NOT NULL,
-            timestamp DATETIME NOT NULL,
-            result_image TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+# Statements are kept as module-level constants so sqlite3's per-connection
+# statement cache (keyed on the SQL string) is hit on every call
+STATEMENT_CACHE_SIZE = 256
+
+SQL_INSERT_VIOLATION = '''
+    INSERT INTO violations (filename, violation_type, confidence, timestamp, result_image, job_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+SQL_SELECT_VIOLATIONS = '''
+    SELECT id, filename, violation_type, confidence, timestamp, result_image 
+    FROM violations 
+    ORDER BY timestamp DESC 
+    LIMIT ?
+'''
+
+SQL_SELECT_VIOLATIONS_BY_FILE = '''
+    SELECT id, filename, violation_type, confidence, timestamp, result_image 
+    FROM violations 
+    WHERE filename = ? 
+    ORDER BY timestamp DESC 
+    LIMIT ?
+'''
+
+SQL_SELECT_STATS_COUNTERS = '''
+    SELECT violation_type, count, conf_sum 
+    FROM stats_counters 
+    ORDER BY count DESC
+'''
+
+SQL_SELECT_VIOLATIONS_BY_JOB = '''
+    SELECT id, filename, violation_type, confidence, timestamp, result_image 
+    FROM violations 
+    WHERE job_id = ? 
+    ORDER BY id
+'''
+
+SQL_COUNT_RECENT = '''
+    SELECT COUNT(*) as recent 
+    FROM violations 
+    WHERE timestamp > ?
+'''
+
+SQL_DELETE_VIOLATION = 'DELETE FROM violations WHERE id = ?'
+
+SQL_INSERT_JOB = '''
+    INSERT INTO jobs (id, filename, status, worker_pid, worker_token)
+    VALUES (?, ?, 'queued', ?, ?)
+'''
+
+SQL_SELECT_UNFINISHED_JOBS = '''
+    SELECT id, worker_pid, worker_token FROM jobs 
+    WHERE status IN ('queued', 'processing')
+'''
+
+SQL_REGISTER_WORKER = 'INSERT OR REPLACE INTO workers (pid, token) VALUES (?, ?)'
+
+SQL_SELECT_WORKERS = 'SELECT pid, token FROM workers'
+
+SQL_UPDATE_JOB = '''
+    UPDATE jobs 
+    SET status = ?, violation_count = ?, error = ?, updated_at = CURRENT_TIMESTAMP 
+    WHERE id = ?
+'''
+
+SQL_SELECT_JOB = 'SELECT * FROM jobs WHERE id = ?'
+
+# Stats are cached for a few seconds and dropped whenever this process
+# writes; the TTL bounds staleness from writes made by other processes
+STATS_CACHE_TTL = 5.0
+
+class SQLitePool:
+    """Fixed-size pool of pre-opened SQLite connections"""
     
-    # Create index for better performance
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_violation_type 
-        ON violations(violation_type)
-    ''')
+    def __init__(self, database: str, size: int = POOL_SIZE):
+        self.database = database
+        self.size = size
+        self.pid = os.getpid()
+        self._pool = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._pool.put(self._connect())
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_timestamp 
-        ON violations(timestamp)
-    ''')
+    def _connect(self) -> sqlite3.Connection:
+        """Open a new connection in autocommit mode with tuned PRAGMAs"""
+        conn = sqlite3.connect(self.database, check_same_thread=False,
+                               isolation_level=None,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Borrow a connection and return it to the pool when done"""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+    
+    def close_all(self):
+        """Close every idle connection in the pool"""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_process_token = None
+_process_token_pid = None
+_process_token_lock = threading.Lock()
+
+_data_version = 0
+_stats_cache = {'version': -1, 'expires': 0.0, 'stats': None}
+_stats_lock = threading.Lock()
+
+def _get_pool() -> SQLitePool:
+    """Create the connection pool on first use in each process"""
+    global _pool
+    # SQLite connections must not cross fork(); a forked worker
+    # (e.g. gunicorn --preload) opens its own pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = SQLitePool(DATABASE_PATH)
+    return _pool
+
+@contextmanager
+def get_connection():
+    """Get a pooled database connection"""
+    with _get_pool().connection() as conn:
+        yield conn
+
+def close_all():
+    """Close all pooled connections (call on shutdown)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
+
+def _invalidate_stats():
+    """Mark cached statistics as stale after a write"""
+    global _data_version
+    with _stats_lock:
+        _data_version += 1
+
+def init_db():
+    """Initialize database with required tables and apply migrations"""
+    with get_connection() as conn:
+        # One write transaction so concurrent workers starting up don't
+        # both run the one-time backfill or migration steps
+        conn.execute('BEGIN IMMEDIATE')
+        
+        # Create violations table (timestamp is unix seconds)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS violations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT NOT NULL,
+                violation_type TEXT NOT NULL,
+                confidence REAL NOT NULL,
+                timestamp INTEGER NOT NULL,
+                result_image TEXT,
+                job_id TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Create index for better performance
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_violation_type 
+            ON violations(violation_type)
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_timestamp 
+            ON violations(timestamp)
+        ''')
+        
+        # Serves the per-file results page without a sort step
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_violations_filename_ts 
+            ON violations(filename, timestamp DESC)
+        ''')
+        
+        # Background processing jobs for uploads
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                status TEXT NOT NULL,
+                violation_count INTEGER,
+                error TEXT,
+                worker_pid INTEGER,
+                worker_token TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Boot token of the process currently running under each pid, so
+        # a job's owner can be told apart from a later process reusing its pid
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS workers (
+                pid INTEGER PRIMARY KEY,
+                token TEXT NOT NULL,
+                started_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Per-type running totals, kept current by triggers so stats
+        # never need to scan the whole violations table
+        counters_exist = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_counters'"
+        ).fetchone()
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                violation_type TEXT PRIMARY KEY,
+                count INTEGER NOT NULL,
+                conf_sum REAL NOT NULL
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_violations_insert_stats
+            AFTER INSERT ON violations
+            BEGIN
+                INSERT INTO stats_counters (violation_type, count, conf_sum)
+                VALUES (NEW.violation_type, 1, NEW.confidence)
+                ON CONFLICT(violation_type) DO UPDATE SET
+                    count = count + 1,
+                    conf_sum = conf_sum + excluded.conf_sum;
+            END
+        ''')
+        
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_violations_delete_stats
+            AFTER DELETE ON violations
+            BEGIN
+                UPDATE stats_counters
+                SET count = count - 1, conf_sum = conf_sum - OLD.confidence
+                WHERE violation_type = OLD.violation_type;
+                DELETE FROM stats_counters
+                WHERE violation_type = OLD.violation_type AND count <= 0;
+            END
+        ''')
+        
+        # Backfill counters for rows written before the table existed
+        if not counters_exist:
+            conn.execute('''
+                INSERT INTO stats_counters (violation_type, count, conf_sum)
+                SELECT violation_type, COUNT(*), SUM(confidence)
+                FROM violations
+                GROUP BY violation_type
+            ''')
+        
+        # Schema version 1: timestamps stored as INTEGER unix seconds.
+        # Older rows hold local-time datetime text; convert them in place.
+        schema_version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if schema_version < 1:
+            conn.execute('''
+                UPDATE violations 
+                SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) 
+                WHERE typeof(timestamp) = 'text'
+            ''')
+        # Schema version 2: jobs record the process that runs them
+        if schema_version < 2:
+            job_columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'worker_pid' not in job_columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN worker_pid INTEGER')
+        # Schema version 3: violations record the upload job that produced them
+        if schema_version < 3:
+            violation_columns = {row['name'] for row in conn.execute('PRAGMA table_info(violations)')}
+            if 'job_id' not in violation_columns:
+                conn.execute('ALTER TABLE violations ADD COLUMN job_id TEXT')
+        # Schema version 4: jobs record their owner's boot token
+        if schema_version < 4:
+            job_columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'worker_token' not in job_columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN worker_token TEXT')
+        if schema_version < SCHEMA_VERSION:
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        
+        # Serves job results; created after the job_id column migration
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_violations_job_id 
+            ON violations(job_id)
+        ''')
+        
+        conn.execute('COMMIT')
     
-    conn.commit()
-    conn.close()
     print("Database initialized successfully")
 
 def save_violation(filename: str, violation_type: str, confidence: float, 
-                  timestamp: datetime, result_image: str = '') -> int:
+                  timestamp: datetime, result_image: str = '',
+                  job_id: Optional[str] = None) -> int:
     """Save violation detection result to database"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with get_connection() as conn:
+        cursor = conn.execute(
+            SQL_INSERT_VIOLATION,
+            (filename, violation_type, confidence, int(timestamp.timestamp()),
+             result_image, job_id)
+        )
     
-    cursor.execute('''
-        INSERT INTO violations (filename, violation_type, confidence, timestamp, result_image)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (filename, violation_type, confidence, timestamp, result_image))
+    _invalidate_stats()
+    return cursor.lastrowid
+
+def save_violations_bulk(rows: List[Tuple]) -> None:
+    """
+    Save many violation rows in a single transaction
     
-    violation_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    Args:
+        rows: (filename, violation_type, confidence, timestamp, result_image, job_id)
+              tuples, with timestamp as integer unix seconds
+    """
+    if not rows:
+        return
     
-    return violation_id
+    with get_connection() as conn:
+        conn.execute('BEGIN')
+        conn.executemany(SQL_INSERT_VIOLATION, rows)
+        conn.execute('COMMIT')
+    
+    _invalidate_stats()
 
 def get_violations(filename: Optional[str] = None, limit: int = 100) -> List[Dict]:
     """Get violations from database"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    if filename:
-        cursor.execute('''
-            SELECT * FROM violations 
-            WHERE filename = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        ''', (filename, limit))
-    else:
-        cursor.execute('''
-            SELECT * FROM violations 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        ''', (limit,))
-    
-    violations = []
-    for row in cursor.fetchall():
-        violations.append({
-            'id': row['id'],
-            'filename': row['filename'],
-            'violation_type': row['violation_type'],
-            'confidence': row['confidence'],
-            'timestamp': row['timestamp'],
-            'result_image': row['result_image']
-        })
-    
-    conn.close()
-    return violations
+    with get_connection() as conn:
+        if filename:
+            rows = conn.execute(SQL_SELECT_VIOLATIONS_BY_FILE, (filename, limit)).fetchall()
+        else:
+            rows = conn.execute(SQL_SELECT_VIOLATIONS, (limit,)).fetchall()
+    
+    return [dict(row) for row in rows]
+
+def get_job_violations(job_id: str) -> List[Dict]:
+    """Get every violation produced by one upload processing job"""
+    with get_connection() as conn:
+        rows = conn.execute(SQL_SELECT_VIOLATIONS_BY_JOB, (job_id,)).fetchall()
+    
+    return [dict(row) for row in rows]
 
 def get_violation_stats() -> Dict:
-    """Get violation statistics"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    """Get violation statistics, served from a short-lived cache"""
+    with _stats_lock:
+        version = _data_version
+        cached = _stats_cache
+        if cached['version'] == version and cached['expires'] > time.monotonic():
+            return cached['stats']
+    
+    stats = _compute_violation_stats()
     
-    # Total violations
-    cursor.execute('SELECT COUNT(*) as total FROM violations')
-    total_violations = cursor.fetchone()['total']
+    with _stats_lock:
+        # Only publish if no write happened while we were querying
+        if _data_version == version:
+            _stats_cache.update(version=version,
+                                expires=time.monotonic() + STATS_CACHE_TTL,
+                                stats=stats)
+    return stats
+
+def _compute_violation_stats() -> Dict:
+    """Build statistics from the per-type counters"""
+    with get_connection() as conn:
+        counters = conn.execute(SQL_SELECT_STATS_COUNTERS).fetchall()
+        
+        # Recent violations (last 24 hours), a range scan on idx_timestamp
+        since = int(time.time()) - 86400
+        recent_violations = conn.execute(SQL_COUNT_RECENT, (since,)).fetchone()['recent']
     
     # Violations by type
-    cursor.execute('''
-        SELECT violation_type, COUNT(*) as count 
-        FROM violations 
-        GROUP BY violation_type 
-        ORDER BY count DESC
-    ''')
-    violations_by_type = {row['violation_type']: row['count'] for row in cursor.fetchall()}
-    
-    # Recent violations (last 24 hours)
-    cursor.execute('''
-        SELECT COUNT(*) as recent 
-        FROM violations 
-        WHERE timestamp > datetime('now', '-1 day')
-    ''')
-    recent_violations = cursor.fetchone()['recent']
-    
-    # Average confidence
-    cursor.execute('SELECT AVG(confidence) as avg_confidence FROM violations')
-    avg_confidence = cursor.fetchone()['avg_confidence'] or 0
-    
-    conn.close()
+    violations_by_type = {row['violation_type']: row['count'] for row in counters}
+    
+    # Total violations and average confidence
+    total_violations = sum(violations_by_type.values())
+    conf_sum = sum(row['conf_sum'] for row in counters)
+    avg_confidence = conf_sum / total_violations if total_violations else 0
     
     return {
         'total_violations': total_violations,
@@ -140,14 +423,96 @@ def get_violation_stats() -> Dict:
 
 def delete_violation(violation_id: int) -> bool:
     """Delete a violation record"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with get_connection() as conn:
+        deleted = conn.execute(SQL_DELETE_VIOLATION, (violation_id,)).rowcount > 0
     
-    cursor.execute('DELETE FROM violations WHERE id = ?', (violation_id,))
-    deleted = cursor.rowcount > 0
+    if deleted:
+        _invalidate_stats()
+    return deleted
+
+def register_process() -> str:
+    """
+    Register this process in the workers table and return its boot token
     
-    conn.commit()
-    conn.close()
+    The token is regenerated after fork, so each server worker gets its own.
+    """
+    global _process_token, _process_token_pid
+    with _process_token_lock:
+        if _process_token_pid != os.getpid():
+            token = uuid.uuid4().hex
+            with get_connection() as conn:
+                conn.execute(SQL_REGISTER_WORKER, (os.getpid(), token))
+            _process_token, _process_token_pid = token, os.getpid()
+        return _process_token
+
+def create_job(job_id: str, filename: str) -> None:
+    """Record a newly queued processing job owned by this process"""
+    token = register_process()
+    with get_connection() as conn:
+        conn.execute(SQL_INSERT_JOB, (job_id, filename, os.getpid(), token))
+
+def update_job(job_id: str, status: str, violation_count: Optional[int] = None,
+               error: Optional[str] = None) -> None:
+    """Update the status of a processing job"""
+    with get_connection() as conn:
+        conn.execute(SQL_UPDATE_JOB, (status, violation_count, error, job_id))
+
+def get_job(job_id: str) -> Optional[Dict]:
+    """Get a processing job by id"""
+    with get_connection() as conn:
+        row = conn.execute(SQL_SELECT_JOB, (job_id,)).fetchone()
     
-    return deleted
+    if row is None:
+        return None
+    
+    return {
+        'job_id': row['id'],
+        'filename': row['filename'],
+        'status': row['status'],
+        'violation_count': row['violation_count'],
+        'error': row['error']
+    }
+
+def _job_owner_alive(pid: Optional[int], token: Optional[str],
+                     worker_tokens: Dict[int, str]) -> bool:
+    """Check whether the process that queued a job is still the one running"""
+    if pid is None or token is None:
+        return False
+    if pid == os.getpid():
+        return token == _process_token
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows; the app runs as
+        # a single process there, so any other owner is gone
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    # A live pid only counts if it is still the process that queued the
+    # job, not a newer one that was handed the same pid
+    return worker_tokens.get(pid) == token
 
+def fail_interrupted_jobs() -> int:
+    """
+    Mark queued/processing jobs whose owning process has exited as failed
+    
+    The job queue is in memory, so a restart, reload or crash drops any
+    jobs it held. Returns the number of jobs marked failed.
+    """
+    # Registering first replaces any stale token left under our own pid
+    register_process()
+    
+    with get_connection() as conn:
+        rows = conn.execute(SQL_SELECT_UNFINISHED_JOBS).fetchall()
+        worker_tokens = {row['pid']: row['token'] for row in conn.execute(SQL_SELECT_WORKERS)}
+    
+    interrupted = [
+        row['id'] for row in rows
+        if not _job_owner_alive(row['worker_pid'], row['worker_token'], worker_tokens)
+    ]
+    for job_id in interrupted:
+        update_job(job_id, 'failed', error='Processing interrupted by restart')
+    
+    return len(interrupted)
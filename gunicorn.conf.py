@@ -0,0 +1,14 @@
+"""
+Gunicorn settings for Traffic Violation Detection App
+Used by start_website.py
+"""
+
+def post_worker_init(worker):
+    """Register the worker, clean up orphaned jobs and warm up the AI model"""
+    # Registering right after fork replaces the boot token of any dead
+    # worker whose pid this one was given, so its jobs are failed
+    from database import fail_interrupted_jobs
+    fail_interrupted_jobs()
+    
+    from main import warm_up_detector
+    warm_up_detector()
@@ -3,28 +3,165 @@ Traffic Violation Detection Flask Application
 Main application file for AI-powered traffic violation detection
 """
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory
+from flask.helpers import get_debug_flag
+from flask.json.provider import DefaultJSONProvider
 import os
+import atexit
+import queue
+import threading
+import time
+import uuid
 import sqlite3
 from datetime import datetime
 import json
 from werkzeug.utils import secure_filename
-import cv2
-import numpy as np
 from models.violation_model import TrafficViolationDetector
-from database import init_db, save_violation, get_violations, get_violation_stats
+try:
+    import orjson
+except ImportError:  # fall back to Flask's stdlib json
+    orjson = None
+from database import (init_db, save_violations_bulk, get_violations, get_violation_stats, close_all,
+                      create_job, update_job, get_job, get_job_violations,
+                      fail_interrupted_jobs)
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider that serializes responses with orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Same argument handling as jsonify(): one positional value, several
+        # positionals as a list, or keyword arguments as an object
+        if args and kwargs:
+            raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+        if len(args) == 1:
+            obj = args[0]
+        elif args:
+            obj = args
+        elif kwargs:
+            obj = kwargs
+        else:
+            obj = None
+        
+        # Send orjson's bytes directly instead of round-tripping through str
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS),
+            mimetype=self.mimetype
+        )
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = ORJSONProvider(app)
 app.config['SECRET_KEY'] = 'traffic_violation_detection_2024'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['RESULTS_FOLDER'] = 'static/results'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
 
+@app.template_filter('datetime')
+def format_timestamp(value):
+    """Format a unix-seconds timestamp for display in local time"""
+    return datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S')
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'avi', 'mov', 'mkv'}
 
-# Initialize AI model
-detector = TrafficViolationDetector()
+_detector = None
+_detector_lock = threading.Lock()
+
+def get_detector() -> TrafficViolationDetector:
+    """Load the AI model on first use instead of at import"""
+    global _detector
+    # Locked so a request arriving during warm-up waits instead of loading twice
+    with _detector_lock:
+        if _detector is None:
+            _detector = TrafficViolationDetector()
+    return _detector
+
+def warm_up_detector():
+    """Load and warm up the AI model in the background"""
+    threading.Thread(target=get_detector, name='model-warmup', daemon=True).start()
+
+# Uploads waiting for detection; drained by one worker thread per process
+_job_queue = queue.Queue()
+_job_worker = None
+_job_worker_lock = threading.Lock()
+
+def process_upload(job_id: str, file_path: str, filename: str):
+    """Detect violations in an uploaded file and store the results"""
+    try:
+        update_job(job_id, 'processing')
+        
+        # Process file for violations
+        results = get_detector().detect_violations(file_path)
+        
+        # Save results to database in one transaction
+        now = int(time.time())
+        rows = [
+            (filename, result['violation_type'], result['confidence'],
+             now, result.get('result_image', ''), job_id)
+            for result in results
+        ]
+        save_violations_bulk(rows)
+        
+        update_job(job_id, 'done', violation_count=len(results))
+        
+    except Exception as e:
+        update_job(job_id, 'failed', error=f'Processing failed: {str(e)}')
+
+def _run_job_worker():
+    """Process queued uploads one at a time"""
+    while True:
+        job_id, file_path, filename = _job_queue.get()
+        try:
+            process_upload(job_id, file_path, filename)
+        except Exception as e:
+            print(f"❌ Job {job_id} failed: {e}")
+        finally:
+            _job_queue.task_done()
+
+def enqueue_upload(job_id: str, file_path: str, filename: str):
+    """Queue an uploaded file for background processing"""
+    global _job_worker
+    
+    create_job(job_id, filename)
+    
+    # Started on first use so each (forked) server worker gets its own thread
+    with _job_worker_lock:
+        if _job_worker is None or not _job_worker.is_alive():
+            _job_worker = threading.Thread(target=_run_job_worker,
+                                           name='detection-worker', daemon=True)
+            _job_worker.start()
+    
+    _job_queue.put((job_id, file_path, filename))
+
+# Release pooled database connections on shutdown
+atexit.register(close_all)
+
+def setup_app():
+    """Create working directories and database tables"""
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['RESULTS_FOLDER'], exist_ok=True)
+    os.makedirs('static/css', exist_ok=True)
+    os.makedirs('static/js', exist_ok=True)
+    
+    # Initialize database
+    init_db()
+    
+    # Jobs left queued/processing by a process that has since exited
+    fail_interrupted_jobs()
+    
+    # Leave no open connections behind: a preloading server (gunicorn
+    # --preload) forks right after import, and SQLite handles must not
+    # cross fork(). The pool reopens lazily on first use.
+    close_all()
+
+# Runs on import so WSGI servers (gunicorn main:app) get a ready app too
+setup_app()
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
@@ -38,7 +175,7 @@ def home():
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    """Handle file upload and process for violations"""
+    """Handle file upload and queue it for violation processing"""
     if 'file' not in request.files:
         return jsonify({'error': 'No file selected'}), 400
     
@@ -49,34 +186,24 @@ def upload_file():
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{filename}"
+        
+        # Job id in the name keeps same-second uploads of one file apart
+        job_id = uuid.uuid4().hex
+        filename = f"{timestamp}_{job_id[:8]}_{filename}"
         
         # Save uploaded file
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(file_path)
         
-        try:
-            # Process file for violations
-            results = detector.detect_violations(file_path)
-            
-            # Save results to database
-            for result in results:
-                save_violation(
-                    filename=filename,
-                    violation_type=result['violation_type'],
-                    confidence=result['confidence'],
-                    timestamp=datetime.now(),
-                    result_image=result.get('result_image', '')
-                )
-            
-            return jsonify({
-                'success': True,
-                'results': results,
-                'filename': filename
-            })
-            
-        except Exception as e:
-            return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+        # Detection runs in the background; clients poll the job status
+        enqueue_upload(job_id, file_path, filename)
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status_url': url_for('api_job', job_id=job_id),
+            'filename': filename
+        }), 202
     
     return jsonify({'error': 'Invalid file type'}), 400
 
@@ -111,25 +238,37 @@ def api_stats():
     stats = get_violation_stats()
     return jsonify(stats)
 
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    """REST API endpoint to get the status of an upload processing job"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job['status'] == 'done':
+        job['results'] = get_job_violations(job_id)
+    
+    return jsonify(job)
+
 @app.route('/static/results/<filename>')
 def serve_result(filename):
     """Serve processed result images"""
-    return send_file(os.path.join(app.config['RESULTS_FOLDER'], filename))
+    # Result filenames are unique per upload, so browsers may cache them
+    return send_from_directory(app.config['RESULTS_FOLDER'], filename,
+                               conditional=True, max_age=86400)
 
 if __name__ == '__main__':
-    # Create necessary directories
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(app.config['RESULTS_FOLDER'], exist_ok=True)
-    os.makedirs('static/css', exist_ok=True)
-    os.makedirs('static/js', exist_ok=True)
-    
-    # Initialize database
-    init_db()
-    
     print("🚦 Traffic Violation Detection App Starting...")
     print("📁 Upload folder:", app.config['UPLOAD_FOLDER'])
     print("📊 Results folder:", app.config['RESULTS_FOLDER'])
     print("🌐 Access the app at: http://localhost:5000")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
-
+    debug = get_debug_flag()
+    
+    # The debug reloader runs this block in a watcher parent too; only the
+    # serving child (WERKZEUG_RUN_MAIN) needs the model
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up_detector()
+    
+    # Development server only; use start_website.py to run under gunicorn/waitress
+    app.run(debug=debug, host='0.0.0.0', port=5000, threaded=True)
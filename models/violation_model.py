@@ -1,14 +1,66 @@
 """
 AI Model for Traffic Violation Detection
 Uses YOLOv8 for detecting various traffic violations
+
+cv2, numpy, torch and ultralytics are imported where they are used so that
+importing this module (and starting the web app) stays cheap.
 """
 
-import cv2
-import numpy as np
-from ultralytics import YOLO
+from __future__ import annotations
+
 import os
-from typing import List, Dict, Tuple
-import torch
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, List, Dict, Tuple, Union
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Background JPEG encode/write so saving overlaps with detection
+_WRITER = ThreadPoolExecutor(max_workers=2, thread_name_prefix='result-writer')
+
+# Colors for different violation types
+VIOLATION_COLORS = {
+    'red_light_jump': (0, 0, 255),      # Red
+    'no_helmet': (0, 165, 255),         # Orange
+    'triple_riding': (255, 0, 0),      # Blue
+    'wrong_lane': (0, 255, 0),         # Green
+    'speeding': (255, 255, 0)          # Yellow
+}
+
+LABEL_SCALE = 0.6
+LABEL_THICKNESS = 2
+
+def _label_prefix(violation_type: str) -> str:
+    """Fixed part of a box label, e.g. 'No Helmet: '"""
+    return f"{violation_type.replace('_', ' ').title()}: "
+
+# Label sizes measured once per violation type. Hershey digits share
+# one advance width, so '0.00' measures the label for any confidence.
+_LABEL_SIZES = {}
+
+# Result images are for display only: cap width and use a lighter JPEG setting
+RESULT_MAX_WIDTH = 1280
+RESULT_JPEG_QUALITY = 80
+
+def _write_result_image(result_path: str, image: np.ndarray) -> bool:
+    """Downscale wide frames and encode the result JPEG (runs on _WRITER)"""
+    import cv2
+    
+    height, width = image.shape[:2]
+    if width > RESULT_MAX_WIDTH:
+        new_height = round(height * RESULT_MAX_WIDTH / width)
+        image = cv2.resize(image, (RESULT_MAX_WIDTH, new_height),
+                           interpolation=cv2.INTER_AREA)
+    params = [cv2.IMWRITE_JPEG_QUALITY, RESULT_JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    return cv2.imwrite(result_path, image, params)
+
+def _report_write_error(future):
+    """Log failures from background image writes"""
+    if future.exception() is not None:
+        print(f"❌ Error saving result image: {future.exception()}")
+    elif not future.result():
+        print("❌ Error saving result image: could not write JPEG")
 
 class TrafficViolationDetector:
     """
@@ -25,6 +77,23 @@ class TrafficViolationDetector:
         """
         self.model_path = model_path
         self.model = None
+        self.device = 'cpu'
+        self.half = False
+        self.imgsz = 640
+        self.batch_size = 8  # Video frames per forward pass
+        self._local = threading.local()  # Pending image writes per request thread
+        
+        # COCO class id -> (violation type, minimum confidence)
+        # Simple heuristic-based violation detection
+        # In a real application, you'd use a custom trained model
+        self._violation_rules = {
+            0: ('no_helmet', 0.7),       # person: assuming rider without helmet
+            3: ('triple_riding', 0.8),   # motorcycle: multiple people on it
+            2: ('wrong_lane', 0.6),      # car: vehicle in wrong lane
+            5: ('wrong_lane', 0.6),      # bus
+            7: ('wrong_lane', 0.6),      # truck
+            1: ('red_light_jump', 0.7),  # bicycle: jumping red light
+        }
         self.violation_classes = {
             'red_light_jump': 0,
             'no_helmet': 1,
@@ -39,6 +108,14 @@ class TrafficViolationDetector:
     def _load_model(self):
         """Load YOLOv8 model"""
         try:
+            import torch
+            from ultralytics import YOLO
+            
+            # Cap intra-op threads when several server workers share the host
+            num_threads = int(os.environ.get('TORCH_NUM_THREADS', '0'))
+            if num_threads > 0:
+                torch.set_num_threads(num_threads)
+            
             if self.model_path and os.path.exists(self.model_path):
                 self.model = YOLO(self.model_path)
                 print(f"✅ Loaded custom model from {self.model_path}")
@@ -46,10 +123,35 @@ class TrafficViolationDetector:
                 # Use pretrained YOLOv8 model
                 self.model = YOLO('yolov8n.pt')
                 print("✅ Loaded pretrained YOLOv8 model")
+            
+            # Run on GPU with FP16 when available
+            self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            self.half = self.device == 'cuda'
+            self.model.to(self.device)
+            print(f"✅ Using device: {self.device}{' (FP16)' if self.half else ''}")
         except Exception as e:
             print(f"❌ Error loading model: {e}")
             # Fallback to basic detection
             self.model = None
+        
+        if self.model is not None:
+            self._warm_up()
+    
+    def _warm_up(self):
+        """Run one dummy forward pass so lazy init isn't paid by the first request"""
+        try:
+            import numpy as np
+            import torch
+            
+            # Call the model directly: _run_detection swallows errors
+            dummy = np.zeros((self.imgsz, self.imgsz, 3), dtype=np.uint8)
+            self.model(dummy, conf=0.5, verbose=False, device=self.device,
+                       half=self.half, imgsz=self.imgsz)
+            if self.device == 'cuda':
+                torch.cuda.synchronize()
+            print("✅ Model warm-up complete")
+        except Exception as e:
+            print(f"❌ Model warm-up failed: {e}")
     
     def detect_violations(self, file_path: str) -> List[Dict]:
         """
@@ -62,12 +164,19 @@ class TrafficViolationDetector:
             List of detected violations with details
         """
         violations = []
+        pending_writes = []
+        self._local.pending_writes = pending_writes
         
-        # Check if file is video or image
-        if self._is_video(file_path):
-            violations = self._process_video(file_path)
-        else:
-            violations = self._process_image(file_path)
+        try:
+            # Check if file is video or image
+            if self._is_video(file_path):
+                violations = self._process_video(file_path)
+            else:
+                violations = self._process_image(file_path)
+        finally:
+            # Result images must be on disk before callers link to them
+            wait(pending_writes)
+            self._local.pending_writes = None
         
         return violations
     
@@ -79,6 +188,8 @@ class TrafficViolationDetector:
     def _process_image(self, image_path: str) -> List[Dict]:
         """Process single image for violations"""
         try:
+            import cv2
+            
             # Read image
             image = cv2.imread(image_path)
             if image is None:
@@ -101,39 +212,70 @@ class TrafficViolationDetector:
         violations = []
         
         try:
+            import cv2
+            
             cap = cv2.VideoCapture(video_path)
             frame_count = 0
             max_frames = 30  # Process max 30 frames to avoid long processing
             
+            # Sampled frames waiting to go through the model as one batch
+            batch_frames = []
+            batch_numbers = []
+            
             while cap.isOpened() and frame_count < max_frames:
-                ret, frame = cap.read()
-                if not ret:
+                # grab() advances without decoding; skipped frames are never decoded
+                if not cap.grab():
                     break
                 
                 # Process every 5th frame to balance accuracy and speed
                 if frame_count % 5 == 0:
-                    results = self._run_detection(frame)
-                    frame_violations = self._process_detection_results(
-                        results, frame, video_path, frame_number=frame_count
-                    )
-                    violations.extend(frame_violations)
+                    ret, frame = cap.retrieve()
+                    if not ret:
+                        break
+                    batch_frames.append(frame)
+                    batch_numbers.append(frame_count)
+                    if len(batch_frames) == self.batch_size:
+                        violations.extend(self._process_frame_batch(
+                            batch_frames, batch_numbers, video_path
+                        ))
+                        batch_frames, batch_numbers = [], []
                 
                 frame_count += 1
             
             cap.release()
             
+            # Flush the partial batch left at end of video
+            if batch_frames:
+                violations.extend(self._process_frame_batch(
+                    batch_frames, batch_numbers, video_path
+                ))
+            
         except Exception as e:
             print(f"❌ Error processing video: {e}")
         
         return violations
     
-    def _run_detection(self, image: np.ndarray) -> List:
-        """Run YOLO detection on image"""
+    def _process_frame_batch(self, frames: List[np.ndarray], frame_numbers: List[int],
+                             video_path: str) -> List[Dict]:
+        """Run one batched forward pass over sampled frames"""
+        violations = []
+        
+        results = self._run_detection(frames)
+        for frame, frame_number, result in zip(frames, frame_numbers, results):
+            violations.extend(self._process_detection_results(
+                [result], frame, video_path, frame_number=frame_number
+            ))
+        
+        return violations
+    
+    def _run_detection(self, image: Union[np.ndarray, List[np.ndarray]]) -> List:
+        """Run YOLO detection on an image or a list of images (one batch)"""
         if self.model is None:
             return []
         
         try:
-            results = self.model(image, conf=0.5, verbose=False)
+            results = self.model(image, conf=0.5, verbose=False, device=self.device,
+                                 half=self.half, imgsz=self.imgsz)
             return results
         except Exception as e:
             print(f"❌ Detection error: {e}")
@@ -148,6 +290,8 @@ class TrafficViolationDetector:
             return violations
         
         try:
+            import numpy as np
+            
             # Get detection results
             result = results[0]
             boxes = result.boxes
@@ -155,34 +299,41 @@ class TrafficViolationDetector:
             if boxes is None or len(boxes) == 0:
                 return violations
             
+            # All boxes for this frame are drawn onto a single copy
+            annotated_image = None
+            
+            # Copy box data to the host in one transfer per field
+            xyxy = boxes.xyxy.cpu().numpy().astype(np.int32).tolist()
+            confs = boxes.conf.cpu().numpy().tolist()
+            class_ids = boxes.cls.cpu().numpy().astype(np.int32).tolist()
+            
             # Process each detection
-            for i, box in enumerate(boxes):
-                # Get box coordinates and confidence
-                x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                confidence = float(box.conf[0].cpu().numpy())
-                class_id = int(box.cls[0].cpu().numpy())
-                
+            for bbox, confidence, class_id in zip(xyxy, confs, class_ids):
                 # Map COCO classes to traffic violations
                 violation_type = self._map_class_to_violation(class_id, confidence)
                 
                 if violation_type:
-                    # Draw bounding box
-                    annotated_image = self._draw_bounding_box(
-                        image.copy(), (int(x1), int(y1), int(x2), int(y2)), 
-                        violation_type, confidence
-                    )
+                    if annotated_image is None:
+                        annotated_image = image.copy()
                     
-                    # Save result image
-                    result_filename = self._save_result_image(
-                        annotated_image, file_path, frame_number, i
+                    # Draw bounding box
+                    self._draw_bounding_box(
+                        annotated_image, tuple(bbox), violation_type, confidence
                     )
                     
                     violations.append({
                         'violation_type': violation_type,
                         'confidence': confidence,
-                        'bbox': [int(x1), int(y1), int(x2), int(y2)],
-                        'result_image': result_filename
+                        'bbox': bbox
                     })
+            
+            # Save one result image per frame, shared by its violations
+            if annotated_image is not None:
+                result_filename = self._save_result_image(
+                    annotated_image, file_path, frame_number, 0
+                )
+                for violation in violations:
+                    violation['result_image'] = result_filename
         
         except Exception as e:
             print(f"❌ Error processing results: {e}")
@@ -194,58 +345,41 @@ class TrafficViolationDetector:
         Map YOLO class IDs to traffic violations
         COCO dataset classes: person, bicycle, car, motorcycle, bus, truck
         """
-        # COCO class mapping
-        coco_classes = {
-            0: 'person', 1: 'bicycle', 2: 'car', 3: 'motorcycle', 
-            5: 'bus', 7: 'truck'
-        }
-        
-        class_name = coco_classes.get(class_id, 'unknown')
-        
-        # Simple heuristic-based violation detection
-        # In a real application, you'd use a custom trained model
-        
-        if class_name == 'person' and confidence > 0.7:
-            return 'no_helmet'  # Assuming person on bike without helmet
-        elif class_name == 'motorcycle' and confidence > 0.8:
-            return 'triple_riding'  # Multiple people on motorcycle
-        elif class_name in ['car', 'bus', 'truck'] and confidence > 0.6:
-            return 'wrong_lane'  # Vehicle in wrong lane
-        elif class_name == 'bicycle' and confidence > 0.7:
-            return 'red_light_jump'  # Bicycle jumping red light
+        rule = self._violation_rules.get(class_id)
+        if rule and confidence > rule[1]:
+            return rule[0]
         
         return None
     
     def _draw_bounding_box(self, image: np.ndarray, bbox: Tuple[int, int, int, int], 
                           violation_type: str, confidence: float) -> np.ndarray:
         """Draw bounding box and label on image"""
-        x1, y1, x2, y2 = bbox
+        import cv2
         
-        # Colors for different violation types
-        colors = {
-            'red_light_jump': (0, 0, 255),      # Red
-            'no_helmet': (0, 165, 255),         # Orange
-            'triple_riding': (255, 0, 0),      # Blue
-            'wrong_lane': (0, 255, 0),         # Green
-            'speeding': (255, 255, 0)          # Yellow
-        }
+        x1, y1, x2, y2 = bbox
         
-        color = colors.get(violation_type, (255, 255, 255))
+        color = VIOLATION_COLORS.get(violation_type, (255, 255, 255))
         
         # Draw rectangle
         cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
         
         # Draw label
-        label = f"{violation_type.replace('_', ' ').title()}: {confidence:.2f}"
-        label_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)[0]
+        label = f"{_label_prefix(violation_type)}{confidence:.2f}"
+        label_size = _LABEL_SIZES.get(violation_type)
+        if label_size is None:
+            label_size = cv2.getTextSize(_label_prefix(violation_type) + '0.00',
+                                         cv2.FONT_HERSHEY_SIMPLEX, LABEL_SCALE,
+                                         LABEL_THICKNESS)[0]
+            _LABEL_SIZES[violation_type] = label_size
+        label_width, label_height = label_size
         
         # Draw label background
-        cv2.rectangle(image, (x1, y1 - label_size[1] - 10), 
-                     (x1 + label_size[0], y1), color, -1)
+        cv2.rectangle(image, (x1, y1 - label_height - 10), 
+                     (x1 + label_width, y1), color, -1)
         
         # Draw label text
         cv2.putText(image, label, (x1, y1 - 5), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+                   cv2.FONT_HERSHEY_SIMPLEX, LABEL_SCALE, (255, 255, 255), LABEL_THICKNESS)
         
         return image
     
@@ -258,8 +392,13 @@ class TrafficViolationDetector:
             result_filename = f"{base_name}_frame{frame_number}_det{detection_id}.jpg"
             result_path = os.path.join('static/results', result_filename)
             
-            # Save image
-            cv2.imwrite(result_path, image)
+            # Save image on the writer pool
+            future = _WRITER.submit(_write_result_image, result_path, image)
+            future.add_done_callback(_report_write_error)
+            
+            pending_writes = getattr(self._local, 'pending_writes', None)
+            if pending_writes is not None:
+                pending_writes.append(future)
             
             return result_filename
             
@@ -275,6 +414,8 @@ class TrafficViolationDetector:
         return {
             "status": "Model loaded",
             "model_path": self.model_path or "Pretrained YOLOv8",
+            "device": self.device,
+            "half_precision": self.half,
             "violation_classes": list(self.violation_classes.keys())
         }
 
@@ -6,6 +6,57 @@ No emoji characters to avoid Windows encoding issues
 import os
 import sys
 import subprocess
+import importlib.util
+
+HOST = '0.0.0.0'
+PORT = 5000
+
+def run_server():
+    """
+    Serve the app with a production WSGI server when available:
+    gunicorn on Linux/macOS, waitress on Windows, else Flask's dev server.
+    Set FLASK_DEBUG=1 to force the debug dev server.
+    """
+    from flask.helpers import get_debug_flag
+    debug = get_debug_flag()
+    
+    if not debug and os.name != 'nt' and importlib.util.find_spec('gunicorn'):
+        # Each worker imports main.py itself, so the DB pool and model are
+        # created per worker after fork. Detection runs on a background
+        # thread, so a couple of workers is enough and keeps the number of
+        # model copies (and CUDA contexts) small.
+        workers = os.environ.get('WEB_CONCURRENCY', '2')
+        
+        # Split the cores between workers instead of every worker's torch
+        # thread pool trying to use all of them
+        env = dict(os.environ)
+        env.setdefault('TORCH_NUM_THREADS',
+                       str(max(1, (os.cpu_count() or 1) // int(workers))))
+        
+        print(f"Serving with gunicorn ({workers} workers x 4 threads)")
+        subprocess.check_call([
+            sys.executable, '-m', 'gunicorn',
+            '-w', workers, '-k', 'gthread', '--threads', '4',
+            '--timeout', '300',  # video uploads can take a while
+            '-c', 'gunicorn.conf.py',
+            '-b', f'{HOST}:{PORT}', 'main:app'
+        ], env=env)
+        return
+    
+    from main import app, warm_up_detector
+    
+    # The debug reloader also runs this in a file-watcher parent that never
+    # serves requests; only warm up in the serving process
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up_detector()
+    
+    if not debug and importlib.util.find_spec('waitress'):
+        from waitress import serve
+        print("Serving with waitress")
+        serve(app, host=HOST, port=PORT, threads=8)
+        return
+    
+    app.run(debug=debug, host=HOST, port=PORT, threaded=True)
 
 def main():
     print("Traffic Violation Detection App - Launcher")
@@ -52,9 +103,7 @@ def main():
     print("=" * 50)
     
     try:
-        # Import and run the Flask app
-        from main import app
-        app.run(debug=True, host='0.0.0.0', port=5000)
+        run_server()
     except KeyboardInterrupt:
         print("\nApplication stopped by user")
     except Exception as e:
@@ -200,8 +200,13 @@ async function handleFormSubmission(e) {
         const result = await response.json();
         
         if (result.success) {
-            displayResults(result.results, result.filename);
-            showAlert('File processed successfully!', 'success');
+            const job = await waitForJob(result.job_id);
+            if (job.status === 'done') {
+                displayResults(job.results, job.filename);
+                showAlert('File processed successfully!', 'success');
+            } else {
+                showAlert('Error: ' + job.error, 'danger');
+            }
         } else {
             showAlert('Error: ' + result.error, 'danger');
         }
@@ -219,6 +224,29 @@ async function handleFormSubmission(e) {
     }
 }
 
+/**
+ * Poll a background processing job until it finishes or the deadline passes
+ */
+async function waitForJob(jobId, interval = 1000, timeout = 10 * 60 * 1000) {
+    const deadline = Date.now() + timeout;
+    
+    while (Date.now() < deadline) {
+        const response = await fetch(`/api/jobs/${jobId}`);
+        const job = await response.json();
+        
+        if (!response.ok) {
+            return { status: 'failed', error: job.error };
+        }
+        if (job.status === 'done' || job.status === 'failed') {
+            return job;
+        }
+        
+        await new Promise(resolve => setTimeout(resolve, interval));
+    }
+    
+    return { status: 'failed', error: 'Timed out waiting for processing to finish' };
+}
+
 /**
  * Display detection results
  */